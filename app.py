@@ -1,21 +1,32 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from matplotlib.backends.backend_pdf import PdfPages
-from rectpack import newPacker
-from collections import defaultdict
+from pypdf import PdfWriter
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-import base64
-import tempfile
+import math
+import multiprocessing
 import os
 from streamlit.components.v1 import html
 
+from packing import pack_pieces
+from rendering import render_sheets, render_svg
+
 st.set_page_config(layout="wide")
 st.title("🔪 Ply Cutting Plan Generator")
 
 st.sidebar.header("Inputs")
 
+PANEL_COLORS = {6: "#ff6666", 12: "#66cc66", 18: "#6699ff"}
+SHEETS_PER_PAGE = 5
+
 # === Kerf Input ===
 kerf = st.sidebar.number_input("Kerf (mm)", min_value=0, max_value=10, value=3)
 
@@ -40,14 +51,18 @@ panel_inputs = {thk: get_panel_input(thk) for thk in [6, 12, 18]}
 
 # === Parse Input ===
 def parse_input(text):
-    panels = []
-    for line in text.strip().splitlines():
-        try:
-            w, h = map(int, line.lower().replace("mm", "").replace("×", "x").split("x"))
-            panels.append((w, h))
-        except:
-            continue
-    return panels
+    dims = (
+        pd.Series(text.strip().splitlines(), dtype=object)
+        .str.lower()
+        .str.replace("mm", "", regex=False)
+        .str.replace("×", "x", regex=False)
+        # At most nine digits per side, so the int cast cannot overflow; no
+        # ply sheet comes near 10^9 mm, so longer numbers are dropped too.
+        .str.extract(r"^\s*(\d{1,9})\s*x\s*(\d{1,9})\s*$")
+        .dropna()
+        .astype(int)
+    )
+    return list(zip(dims[0].tolist(), dims[1].tolist()))
 
 thickness_config = {}
 for thk in [6, 12, 18]:
@@ -55,133 +70,176 @@ for thk in [6, 12, 18]:
     ply_w, ply_h = map(int, size_str.split("x"))
     pieces = parse_input(panel_inputs[thk])
     if pieces:
-        grouped = defaultdict(int)
-        for w, h in pieces:
-            grouped[(w, h)] += 1
+        grouped = Counter(pieces)
         thickness_config[thk] = {
-            "color": {6: "#ff6666", 12: "#66cc66", 18: "#6699ff"}[thk],
+            "color": PANEL_COLORS[thk],
             "ply_width": ply_w,
             "ply_height": ply_h,
             "pieces": [(w, h, qty) for (w, h), qty in grouped.items()]
         }
 
-# === Process Logic ===
-temp_dir = tempfile.TemporaryDirectory()
-pdf_path = os.path.join(temp_dir.name, "cutting_plan_by_thickness.pdf")
-pdf = PdfPages(pdf_path)
-
-summary = []
-image_sections = []
-
 # === Legend Page ===
-fig, ax = plt.subplots(figsize=(8, 4))
-ax.axis('off')
-ax.set_title("Panel Thickness Legend", fontsize=14, weight='bold')
-
-for i, (thk, cfg) in enumerate(thickness_config.items()):
-    ax.add_patch(Rectangle((0.1, 0.8 - i * 0.3), 0.1, 0.1, color=cfg['color']))
-    ax.text(0.25, 0.8 - i * 0.3 + 0.05, f"{thk} mm Panel", va='center', fontsize=12)
-
-plt.tight_layout()
-pdf.savefig(fig)
-plt.close()
+@st.cache_data(show_spinner=False)
+def render_legend(thicknesses):
+    """Render the thickness legend as a single-page PDF."""
+    buf = BytesIO()
+    with PdfPages(buf) as pdf:
+        fig, ax = plt.subplots(figsize=(8, 4))
+        ax.axis('off')
+        ax.set_title("Panel Thickness Legend", fontsize=14, weight='bold')
+
+        for i, thk in enumerate(thicknesses):
+            ax.add_patch(Rectangle((0.1, 0.8 - i * 0.3), 0.1, 0.1, color=PANEL_COLORS[thk]))
+            ax.text(0.25, 0.8 - i * 0.3 + 0.05, f"{thk} mm Panel", va='center', fontsize=12)
+
+        fig.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
+    return buf.getvalue()
+
+# === Render Worker Pool ===
+@st.cache_resource
+def render_pool():
+    """Process pool shared by all sessions for rendering sheets.
+
+    Workers start from a forkserver, or by spawning where there is none
+    (Windows), rather than by forking the threaded Streamlit server;
+    ``rendering`` imports without Streamlit for this.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=os.cpu_count(),
+                               mp_context=multiprocessing.get_context(method))
+
+# === Pack One Thickness ===
+@st.cache_data(show_spinner=False)
+def pack_sheets(thickness, kerf, ply_width, ply_height, pieces):
+    """Pack ``pieces`` onto ply sheets.
+
+    Returns ``(sheets, summary)`` where ``sheets`` is a list of
+    ``(sheet_id, rects, waste_percent)`` and ``rects`` an ``(n, 6)`` array of
+    ``x, y, w, h, ow, oh`` rows.
+    """
+    # Group placements by sheet with one stable sort; each sheet becomes an
+    # (n, 6) array of x, y, w, h, ow, oh rows.
+    placements = pack_pieces(pieces, kerf, ply_width, ply_height)
+    placements = placements[np.argsort(placements[:, 0], kind='stable')]
+    split_idx = np.flatnonzero(np.diff(placements[:, 0])) + 1
+    sheets = {int(chunk[0, 0]): chunk[:, 1:]
+              for chunk in np.split(placements, split_idx) if len(chunk)}
+
+    total_area = ply_width * ply_height
+    used_areas = np.array([(rects[:, 2].astype(np.int64) * rects[:, 3]).sum()
+                           for rects in sheets.values()], dtype=np.int64)
+    waste_pct = (total_area - used_areas) * (100.0 / total_area)
+
+    summary = {
+        "Thickness (mm)": thickness,
+        "Total Sheets": len(sheets),
+        "Total Pieces": sum(qty for _, _, qty in pieces),
+        "Approx Waste %": f"{waste_pct.mean():.2f}%" if len(sheets) else "n/a"
+    }
+    return list(zip(sheets, sheets.values(), waste_pct.tolist())), summary
+
+# === Render One Thickness to PDF ===
+@st.cache_data(show_spinner=False)
+def render_pdf_batches(thickness, kerf, ply_width, ply_height, pieces):
+    """Render every sheet of one thickness.
+
+    Returns the batch PDFs in sheet order, exactly as the workers wrote
+    them; they are merged once, with the legend, into the final plan.
+    """
+    sheets, _ = pack_sheets(thickness, kerf, ply_width, ply_height, pieces)
+
+    # Split the sheets into one contiguous batch per worker; each batch is
+    # rendered as one multi-page PDF on the worker's reused figure.
+    batch_size = max(1, math.ceil(len(sheets) / (os.cpu_count() or 1)))
+    batches = [sheets[i:i + batch_size] for i in range(0, len(sheets), batch_size)]
+    color = PANEL_COLORS[thickness]
+
+    def render_on(pool):
+        futures = [pool.submit(render_sheets, thickness, batch, ply_width, ply_height, color)
+                   for batch in batches]
+        return [future.result() for future in futures]
+
+    pool = render_pool()
+    try:
+        return render_on(pool)
+    except BrokenProcessPool:
+        # A dead worker breaks the cached pool for every session, so replace
+        # it and retry once; a second failure is a real error.
+        pool.shutdown(wait=False, cancel_futures=True)
+        render_pool.clear()
+        return render_on(render_pool())
+
+# === Sheet Pagination ===
+def turn_page(thickness, step):
+    st.session_state[f"page_{thickness}"] += step
 
 # === Loop for Each Thickness ===
+summary = []
+plan_args = []
+
 for thickness, config in thickness_config.items():
-    ply_width = config["ply_width"]
-    ply_height = config["ply_height"]
-    color = config["color"]
-    pieces = config["pieces"]
-
-    rectangles = []
-    original_dims = []
-
-    for w, h, qty in pieces:
-        for _ in range(qty):
-            rid = len(original_dims)
-            rectangles.append((w + kerf, h + kerf, rid))
-            original_dims.append((w, h))
-
-    packer = newPacker(rotation=True)
-    for w, h, rid in rectangles:
-        packer.add_rect(w, h, rid)
-    for _ in range(100):
-        packer.add_bin(ply_width, ply_height)
-    packer.pack()
-
-    used_rects = packer.rect_list()
-    sheets = defaultdict(list)
-    for bin_id, x, y, w, h, rid in used_rects:
-        true_w, true_h = w - kerf, h - kerf
-        ow, oh = original_dims[rid]
-        sheets[bin_id].append((x, y, true_w, true_h, ow, oh))
+    args = (thickness, kerf, config["ply_width"], config["ply_height"],
+            tuple(sorted(config["pieces"])))
+    sheets, thickness_summary = pack_sheets(*args)
+    plan_args.append(args)
+    summary.append(thickness_summary)
+
+    # Only the current page of sheets is drawn; page turns rerun the script
+    # but hit the packing and PDF caches.
+    n_pages = max(1, math.ceil(len(sheets) / SHEETS_PER_PAGE))
+    page_key = f"page_{thickness}"
+    page = min(st.session_state.get(page_key, 0), n_pages - 1)
+    st.session_state[page_key] = page
+    visible = sheets[page * SHEETS_PER_PAGE:(page + 1) * SHEETS_PER_PAGE]
 
     scroll_html = ""  # HTML section for this thickness
 
-    for sheet_id, rects in sheets.items():
-        fig, ax = plt.subplots(figsize=(4, 8))
-        ax.set_xlim(0, ply_width)
-        ax.set_ylim(0, ply_height)
-        ax.set_aspect('equal')
-        ax.invert_yaxis()
-        ax.set_facecolor("#f5f5f5")
-
-        used_area = 0
-        for x, y, w, h, ow, oh in rects:
-            ax.add_patch(Rectangle((x, y), w, h, edgecolor='black', facecolor=color, lw=1.2))
-            ax.text(x + w/2, y + h/2, f"{int(ow)}×{int(oh)}",
-                    fontsize=8, ha='center', va='center',
-                    bbox=dict(facecolor='white', edgecolor='none', pad=1))
-            used_area += w * h
-
-        total_area = ply_width * ply_height
-        waste = total_area - used_area
-        waste_percent = (waste / total_area) * 100
-
-        fig.suptitle(f"{thickness}mm Sheet {sheet_id+1} | Waste: {waste_percent:.2f}%", fontsize=10)
-
-        buf = BytesIO()
-        fig.savefig(buf, format='png', bbox_inches='tight')
-        plt.close(fig)
-        img_base64 = base64.b64encode(buf.getvalue()).decode()
-
+    for sheet_id, rects, waste_percent in visible:
+        svg = render_svg(rects, config["ply_width"], config["ply_height"], config["color"])
         scroll_html += f"""
         <div style='display:flex;margin-bottom:16px;'>
             <div style='min-width:100px;text-align:center;'>
-                <img src='data:image/png;base64,{img_base64}' width='50'><br>
+                <div style='width:50px;margin:auto;'>{svg}</div>
                 Sheet {sheet_id+1}<br>
                 Waste: {waste_percent:.2f}%
             </div>
-            <div style='flex:1;'>
-                <img class='sheet-img' src='data:image/png;base64,{img_base64}' style='width:100%;max-width:600px;'>
+            <div class='sheet-img' style='flex:1;max-width:600px;'>
+                {svg}
             </div>
         </div>
         """
-        pdf.savefig(fig)
-
-    summary.append({
-        "Thickness (mm)": thickness,
-        "Total Sheets": len(sheets),
-        "Total Pieces": len(original_dims),
-        "Approx Waste %": f"{(sum([(ply_width * ply_height - sum(w * h for _, _, w, h, *_ in s)) / (ply_width * ply_height) * 100 for s in sheets.values()]) / len(sheets)):.2f}%"
-    })
 
     with st.container():
         st.markdown(f"### {thickness}mm Panel Sheets")
         html(scroll_html, height=600, scrolling=True)
-
-pdf.close()
+        if n_pages > 1:
+            prev_col, info_col, next_col = st.columns([1, 2, 1])
+            prev_col.button("◀ Previous", key=f"prev_{thickness}", disabled=page == 0,
+                            on_click=turn_page, args=(thickness, -1))
+            info_col.caption(f"Sheets {page * SHEETS_PER_PAGE + 1}–"
+                             f"{page * SHEETS_PER_PAGE + len(visible)} of {len(sheets)}")
+            next_col.button("Next ▶", key=f"next_{thickness}", disabled=page == n_pages - 1,
+                            on_click=turn_page, args=(thickness, 1))
 
 # === Summary Table ===
 if summary:
     st.markdown("## 🧾 Summary")
     st.dataframe(pd.DataFrame(summary))
 
+# === Merge PDF Parts ===
+writer = PdfWriter()
+writer.append(BytesIO(render_legend(tuple(thickness_config.keys()))))
+for args in plan_args:
+    for batch in render_pdf_batches(*args):
+        writer.append(BytesIO(batch))
+pdf_buf = BytesIO()
+writer.write(pdf_buf)
+
 # === PDF Download ===
-with open(pdf_path, "rb") as f:
-    b64_pdf = base64.b64encode(f.read()).decode()
-    href = f'<a href="data:application/octet-stream;base64,{b64_pdf}" download="cutting_plan.pdf">📥 Download Cutting Plan PDF</a>'
-    st.markdown(href, unsafe_allow_html=True)
+st.download_button("📥 Download Cutting Plan PDF", data=pdf_buf.getvalue(),
+                   file_name="cutting_plan.pdf", mime="application/pdf")
 
 st.success("Done! Paste your panel sizes above to begin.")
 
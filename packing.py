@@ -0,0 +1,456 @@
+"""Rectangle packing onto ply sheets.
+
+The default packers are MaxRects and Guillotine best-short-side-fit
+packers compiled with Numba; each job keeps whichever plan uses the fewest
+sheets. ``rectpack`` is used when Numba is missing or fails to compile them.
+"""
+import functools
+import math
+import warnings
+
+import numpy as np
+from rectpack import newPacker, GuillotineBssfSas, SORT_LSIDE, PackingBin
+
+try:
+    from numba import njit
+    from numba.core.errors import NumbaError
+except ImportError:
+    njit = None
+
+# Strips are only formed for rectpack jobs with at least this many pieces,
+# and only when a row covers this fraction of the bin width.
+STRIP_MIN_PIECES = 500
+STRIP_MIN_FILL = 0.95
+
+
+def _jit(func):
+    return njit(cache=True)(func) if njit is not None else func
+
+
+@_jit
+def short_side_fit(fw, fh, w, h):
+    """Shorter leftover side when ``w`` x ``h`` goes into an ``fw`` x ``fh``
+    free rect, or -1 when it does not fit."""
+    if w > fw or h > fh:
+        return -1
+    return min(fw - w, fh - h)
+
+
+@_jit
+def find_best_short_side_fit(fw, fh, fb, n_free, w, h):
+    """Index of the free rect that leaves the shortest side around ``w`` x
+    ``h``, and whether the rect has to be rotated to fit it. The index is -1
+    when none fits.
+
+    Ties go to the earlier bin and, within a bin, to the unrotated rect, as
+    with rectpack's MaxRectsBssf and BBF bin selection.
+    """
+    best = -1
+    best_score = 0
+    rotated = False
+    for i in range(n_free):
+        score = short_side_fit(fw[i], fh[i], w, h)
+        if score >= 0 and (best < 0 or score < best_score
+                           or (score == best_score and rotated and fb[i] == fb[best])):
+            best, best_score, rotated = i, score, False
+        score = short_side_fit(fw[i], fh[i], h, w)
+        if score >= 0 and (best < 0 or score < best_score):
+            best, best_score, rotated = i, score, True
+    return best, rotated
+
+
+@_jit
+def fits_empty_bin(w, h, bin_w, bin_h):
+    """Whether ``w`` x ``h`` fits an empty bin, and whether it goes in
+    rotated, scored like any other free rect."""
+    upright = short_side_fit(bin_w, bin_h, w, h)
+    turned = short_side_fit(bin_w, bin_h, h, w)
+    return upright >= 0 or turned >= 0, upright < 0 or 0 <= turned < upright
+
+
+@_jit
+def split_free(fx, fy, fw, fh, fb, n_free, i, rw, rh):
+    """Place ``rw`` x ``rh`` in the top-left corner of free rect ``i`` and
+    replace it with the leftover pieces. Returns the new free count."""
+    x, y, w, h, b = fx[i], fy[i], fw[i], fh[i], fb[i]
+
+    n_free -= 1
+    fx[i], fy[i], fw[i], fh[i], fb[i] = fx[n_free], fy[n_free], fw[n_free], fh[n_free], fb[n_free]
+
+    left_w = w - rw
+    left_h = h - rh
+    # Split along the free rect's shorter axis.
+    if w < h:
+        right_h, bottom_w = rh, w
+    else:
+        right_h, bottom_w = h, rw
+
+    if left_w > 0 and right_h > 0:
+        fx[n_free], fy[n_free], fw[n_free], fh[n_free], fb[n_free] = x + rw, y, left_w, right_h, b
+        n_free += 1
+    if left_h > 0 and bottom_w > 0:
+        fx[n_free], fy[n_free], fw[n_free], fh[n_free], fb[n_free] = x, y + rh, bottom_w, left_h, b
+        n_free += 1
+    return n_free
+
+
+@_jit
+def expand(pieces_wh, pieces_q, kerf):
+    """One ``w + kerf, h + kerf, w, h`` row per piece of each group.
+
+    Rows are int64 so adding the kerf cannot wrap for any size that fits
+    an int64.
+    """
+    out = np.empty((pieces_q.sum(), 4), np.int64)
+    k = 0
+    for i in range(len(pieces_q)):
+        for _ in range(pieces_q[i]):
+            out[k, 0] = pieces_wh[i, 0] + kerf
+            out[k, 1] = pieces_wh[i, 1] + kerf
+            out[k, 2] = pieces_wh[i, 0]
+            out[k, 3] = pieces_wh[i, 1]
+            k += 1
+    return out
+
+
+@_jit
+def pack_guillotine(widths, heights, bin_w, bin_h, order):
+    """Guillotine-pack every rect in ``order``, opening bins as needed.
+
+    Returns an ``(n_placed, 6)`` array of ``bin, x, y, w, h, index`` rows.
+    Rects larger than an empty bin are skipped.
+    """
+    n = len(widths)
+    # Every placement removes one free rect and adds at most two, and every
+    # bin adds one, so there are never more than 2n free rects.
+    cap = 2 * n + 1
+    fx = np.empty(cap, np.int32)
+    fy = np.empty(cap, np.int32)
+    fw = np.empty(cap, np.int32)
+    fh = np.empty(cap, np.int32)
+    fb = np.empty(cap, np.int32)
+    out = np.empty((n, 6), np.int32)
+    n_free = 0
+    n_bins = 0
+    n_out = 0
+
+    for k in range(n):
+        r = order[k]
+        w = widths[r]
+        h = heights[r]
+        i, rotated = find_best_short_side_fit(fw, fh, fb, n_free, w, h)
+        if i < 0:
+            fits, rotated = fits_empty_bin(w, h, bin_w, bin_h)
+            if not fits:
+                continue
+            fx[n_free], fy[n_free], fw[n_free], fh[n_free], fb[n_free] = 0, 0, bin_w, bin_h, n_bins
+            i = n_free
+            n_free += 1
+            n_bins += 1
+
+        rw, rh = (h, w) if rotated else (w, h)
+        out[n_out, 0] = fb[i]
+        out[n_out, 1] = fx[i]
+        out[n_out, 2] = fy[i]
+        out[n_out, 3] = rw
+        out[n_out, 4] = rh
+        out[n_out, 5] = r
+        n_out += 1
+        n_free = split_free(fx, fy, fw, fh, fb, n_free, i, rw, rh)
+    return out[:n_out]
+
+
+@_jit
+def split_maximal(free, n_free, px, py, rw, rh, out):
+    """Write the ``x, y, w, h`` free rects of one bin to ``out``, replacing
+    each one that overlaps the placed rect with its up to four maximal
+    leftovers. Returns the new count."""
+    n_out = 0
+    for i in range(n_free):
+        x, y, w, h = free[i, 0], free[i, 1], free[i, 2], free[i, 3]
+        if px >= x + w or px + rw <= x or py >= y + h or py + rh <= y:
+            out[n_out] = free[i]
+            n_out += 1
+            continue
+        if px > x:
+            out[n_out, 0], out[n_out, 1], out[n_out, 2], out[n_out, 3] = x, y, px - x, h
+            n_out += 1
+        if px + rw < x + w:
+            out[n_out, 0], out[n_out, 1], out[n_out, 2], out[n_out, 3] = px + rw, y, x + w - px - rw, h
+            n_out += 1
+        if py + rh < y + h:
+            out[n_out, 0], out[n_out, 1], out[n_out, 2], out[n_out, 3] = x, py + rh, w, y + h - py - rh
+            n_out += 1
+        if py > y:
+            out[n_out, 0], out[n_out, 1], out[n_out, 2], out[n_out, 3] = x, y, w, py - y
+            n_out += 1
+    return n_out
+
+
+@_jit
+def prune_contained(free, n_free):
+    """Drop free rects that lie inside another one, keeping the first of
+    equal rects. Compacts ``free`` and returns the new count."""
+    keep = np.ones(n_free, np.bool_)
+    for i in range(n_free):
+        for j in range(n_free):
+            if j == i or not keep[j]:
+                continue
+            inside = (free[j, 0] <= free[i, 0] and free[j, 1] <= free[i, 1]
+                      and free[i, 0] + free[i, 2] <= free[j, 0] + free[j, 2]
+                      and free[i, 1] + free[i, 3] <= free[j, 1] + free[j, 3])
+            equal = (free[i, 0] == free[j, 0] and free[i, 1] == free[j, 1]
+                     and free[i, 2] == free[j, 2] and free[i, 3] == free[j, 3])
+            if inside and (j < i or not equal):
+                keep[i] = False
+                break
+    n_kept = 0
+    for i in range(n_free):
+        if keep[i]:
+            free[n_kept] = free[i]
+            n_kept += 1
+    return n_kept
+
+
+@_jit
+def pack_maxrects(widths, heights, bin_w, bin_h, order):
+    """MaxRects-pack every rect in ``order``, opening bins as needed.
+
+    Free space is kept as the maximal free rects of each bin, in one block
+    per bin in the order the bins were opened. Returns the same rows as
+    ``pack_guillotine``.
+    """
+    n = len(widths)
+    free = np.empty((64, 5), np.int32)
+    block = np.empty((64, 5), np.int32)
+    out = np.empty((n, 6), np.int32)
+    n_free = 0
+    n_bins = 0
+    n_out = 0
+
+    for k in range(n):
+        r = order[k]
+        w = widths[r]
+        h = heights[r]
+        i, rotated = find_best_short_side_fit(free[:, 2], free[:, 3], free[:, 4], n_free, w, h)
+        if i < 0:
+            fits, rotated = fits_empty_bin(w, h, bin_w, bin_h)
+            if not fits:
+                continue
+            if n_free == len(free):
+                grown = np.empty((2 * len(free), 5), np.int32)
+                grown[:n_free] = free[:n_free]
+                free = grown
+            free[n_free, 0], free[n_free, 1], free[n_free, 2], free[n_free, 3] = 0, 0, bin_w, bin_h
+            free[n_free, 4] = n_bins
+            i = n_free
+            n_free += 1
+            n_bins += 1
+
+        rw, rh = (h, w) if rotated else (w, h)
+        b, x, y = free[i, 4], free[i, 0], free[i, 1]
+        out[n_out, 0] = b
+        out[n_out, 1] = x
+        out[n_out, 2] = y
+        out[n_out, 3] = rw
+        out[n_out, 4] = rh
+        out[n_out, 5] = r
+        n_out += 1
+
+        # Only bin b's block changes; each overlapped rect becomes at most four.
+        lo = np.searchsorted(free[:n_free, 4], b)
+        hi = np.searchsorted(free[:n_free, 4], b + 1)
+        if len(block) < 4 * (hi - lo):
+            block = np.empty((8 * (hi - lo), 5), np.int32)
+        n_block = split_maximal(free[lo:hi], hi - lo, x, y, rw, rh, block)
+        n_block = prune_contained(block, n_block)
+        block[:n_block, 4] = b
+
+        n_new = n_free - (hi - lo) + n_block
+        if n_new > len(free):
+            grown = np.empty((2 * n_new, 5), np.int32)
+            grown[:lo] = free[:lo]
+            grown[lo + n_block:n_new] = free[hi:n_free]
+            free = grown
+        else:
+            free[lo + n_block:n_new] = free[hi:n_free].copy()
+        free[lo:lo + n_block] = block[:n_block]
+        n_free = n_new
+    return out[:n_out]
+
+
+def sort_orders(widths, heights):
+    """Rect orders the Numba packer tries: descending area, perimeter, long
+    side and short side. The area order is stable, like rectpack's
+    SORT_AREA, so that pass reproduces the rectpack default."""
+    widths = widths.astype(np.int64)
+    heights = heights.astype(np.int64)
+    long_side = np.maximum(widths, heights)
+    short_side = np.minimum(widths, heights)
+    return [
+        np.argsort(-(widths * heights), kind='stable'),
+        np.lexsort((-long_side, -(widths + heights))),
+        np.lexsort((-short_side, -long_side)),
+        np.lexsort((-long_side, -short_side)),
+    ]
+
+
+def bin_count(placed):
+    """Number of bins used by ``bin, ...`` placement rows."""
+    return int(placed[:, 0].max()) + 1 if len(placed) else 0
+
+
+def _pack_rectpack(rects, bin_w, bin_h):
+    # Start from the area lower bound plus slack; if that leaves rects out,
+    # retry with one bin per rect, which is enough for every rect that fits.
+    n_bins = math.ceil(sum(w * h for w, h, _ in rects) / (bin_w * bin_h)) + 2
+    while True:
+        packer = newPacker(pack_algo=GuillotineBssfSas, sort_algo=SORT_LSIDE,
+                           bin_algo=PackingBin.BFF, rotation=True)
+        for w, h, rid in rects:
+            packer.add_rect(w, h, rid)
+        packer.add_bin(bin_w, bin_h, count=n_bins)
+        packer.pack()
+        placed = packer.rect_list()
+        if len(placed) == len(rects) or n_bins >= len(rects):
+            return placed
+        n_bins = len(rects)
+
+
+def _pack_numba(pieces, kerf, bin_w, bin_h):
+    """Pack ``(w, h, qty)`` groups with the Numba packers and return the
+    placements array, or None when Numba is missing or fails to compile."""
+    if njit is None:
+        return None
+    try:
+        groups = np.array(pieces, dtype=np.int64).reshape(-1, 3)
+        dims = expand(groups[:, :2], groups[:, 2], kerf)
+        widths, heights = dims[:, 0].copy(), dims[:, 1].copy()
+        # Try both packers over every order and keep the plan with the fewest
+        # bins. The first pass reproduces rectpack's default packer.
+        placed = None
+        for order in sort_orders(widths, heights):
+            for packer in (pack_maxrects, pack_guillotine):
+                plan = packer(widths, heights, bin_w, bin_h, order)
+                if placed is None or bin_count(plan) < bin_count(placed):
+                    placed = plan
+    except NumbaError as exc:
+        warnings.warn(f"Numba packer unavailable, falling back to rectpack: {exc}")
+        return None
+    placements = np.empty((len(placed), 7), np.int32)
+    placements[:, :3] = placed[:, :3]
+    placements[:, 3:5] = placed[:, 3:5] - kerf
+    placements[:, 5:] = dims[placed[:, 5], 2:4]
+    return placements
+
+
+def strip_rects(pieces, kerf, bin_w=None):
+    """Turn ``(w, h, qty)`` groups into ``(w, h, rid)`` rects to pack.
+
+    Each rid is ``(ow, oh, cell_w, cell_h, k)``: the original size, the
+    kerf-inclusive cell each piece occupies and the number of pieces laid
+    side by side along the rect. With ``bin_w`` repeated sizes are grouped
+    into rows that span at least ``STRIP_MIN_FILL`` of the bin width;
+    otherwise every piece is its own rect.
+    """
+    rects = []
+    for w, h, qty in pieces:
+        pw, ph = w + kerf, h + kerf
+        cell_w, cell_h, per_strip = pw, ph, 1
+        if bin_w is not None:
+            for cw, ch in ((pw, ph), (ph, pw)):
+                k = bin_w // cw
+                if k > per_strip and k * cw >= STRIP_MIN_FILL * bin_w:
+                    cell_w, cell_h, per_strip = cw, ch, k
+        while qty >= per_strip:
+            rects.append((per_strip * cell_w, cell_h, (w, h, cell_w, cell_h, per_strip)))
+            qty -= per_strip
+        for _ in range(qty):
+            rects.append((pw, ph, (w, h, pw, ph, 1)))
+    return rects
+
+
+def unfold_strips(placed, kerf):
+    """Expand packed rects into ``(bin_id, x, y, w, h, ow, oh)`` pieces,
+    with ``w`` and ``h`` the placed size without kerf."""
+    pieces = []
+    for bin_id, x, y, w, h, (ow, oh, cell_w, cell_h, k) in placed:
+        if w == k * cell_w and h == cell_h:
+            for i in range(k):
+                pieces.append((bin_id, x + i * cell_w, y, cell_w - kerf, cell_h - kerf, ow, oh))
+        else:
+            for i in range(k):
+                pieces.append((bin_id, x, y + i * cell_w, cell_h - kerf, cell_w - kerf, ow, oh))
+    return pieces
+
+
+def pack_pieces(pieces, kerf, bin_w, bin_h):
+    """Pack ``(w, h, qty)`` groups with ``kerf`` added to each piece.
+
+    Returns a read-only ``(n, 7)`` int32 array with one
+    ``bin_id, x, y, w, h, ow, oh`` row per placed piece; pieces that fit no
+    bin are dropped. Results are memoised on the sorted groups, so
+    Streamlit reruns with unchanged inputs do not repack.
+    """
+    return _pack(kerf, bin_w, bin_h, tuple(sorted(pieces)))
+
+
+def fitting_groups(pieces, kerf, bin_w, bin_h):
+    """Drop ``(w, h, qty)`` groups whose kerf-inclusive size fits an empty bin
+    in neither orientation. Done in Python ints before any NumPy/Numba
+    conversion, so every remaining size is bounded by the bin and fits int32."""
+    fitting = []
+    for w, h, qty in pieces:
+        pw, ph = w + kerf, h + kerf
+        if (pw <= bin_w and ph <= bin_h) or (ph <= bin_w and pw <= bin_h):
+            fitting.append((w, h, qty))
+    return tuple(fitting)
+
+
+@functools.lru_cache(maxsize=64)
+def _pack(kerf, bin_w, bin_h, pieces):
+    pieces = fitting_groups(pieces, kerf, bin_w, bin_h)
+    placements = _pack_numba(pieces, kerf, bin_w, bin_h)
+    if placements is None:
+        # rectpack slows down sharply with the rect count, so large jobs
+        # group repeated sizes into strips at the cost of a few more sheets.
+        n_pieces = sum(qty for _, _, qty in pieces)
+        strip_w = bin_w if n_pieces >= STRIP_MIN_PIECES else None
+        placed = _pack_rectpack(strip_rects(pieces, kerf, strip_w), bin_w, bin_h)
+        placements = np.array(unfold_strips(placed, kerf), dtype=np.int32).reshape(-1, 7)
+    placements.flags.writeable = False
+    return placements
+
+
+if __name__ == "__main__":
+    # ``python packing.py`` packs a fixed set of random jobs and checks each
+    # plan places every piece in bounds without overlaps, on no more sheets
+    # than rectpack's default packer given the same pieces.
+    import random
+
+    kerf, bin_w, bin_h = 3, 1220, 2440
+    rng = random.Random(0)
+    for job in range(30):
+        pieces = sorted((rng.randint(50, 1200), rng.randint(50, 2400), rng.randint(1, 6))
+                        for _ in range(rng.randint(5, 40)))
+        placements = pack_pieces(pieces, kerf, bin_w, bin_h)
+        assert len(placements) == sum(qty for _, _, qty in pieces), job
+
+        b, x, y, w, h, ow, oh = placements.T
+        assert (np.minimum(w, h) == np.minimum(ow, oh)).all(), job
+        assert (np.maximum(w, h) == np.maximum(ow, oh)).all(), job
+        x2, y2 = x + w + kerf, y + h + kerf
+        assert (x >= 0).all() and (y >= 0).all(), job
+        assert (x2 <= bin_w).all() and (y2 <= bin_h).all(), job
+        overlap = ((b[:, None] == b) & (x[:, None] < x2) & (x < x2[:, None])
+                   & (y[:, None] < y2) & (y < y2[:, None]))
+        assert overlap.sum() == len(placements), job
+
+        packer = newPacker(rotation=True)
+        for w, h, qty in pieces:
+            for _ in range(qty):
+                packer.add_rect(w + kerf, h + kerf)
+        packer.add_bin(bin_w, bin_h, count=len(placements))
+        packer.pack()
+        assert bin_count(placements) <= len(packer), job
+    print("packing ok")
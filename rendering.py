@@ -0,0 +1,105 @@
+"""Sheet rendering: matplotlib PDF pages and SVG previews.
+
+``render_sheets`` runs inside the render process pool. Everything here is
+importable without Streamlit so workers can unpickle it by reference.
+"""
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.patches import Rectangle
+from matplotlib.collections import PatchCollection
+from matplotlib.backends.backend_pdf import PdfPages
+from io import BytesIO
+
+# PDF pages are vector, so this only affects rasterised parts.
+PDF_DPI = 150
+
+# Smallest on-figure piece size, in pixels, that gets a size label.
+LABEL_MIN_PX = (20, 10)
+
+_sheet_figure = None
+
+
+def get_sheet_figure():
+    """Return this process's sheet ``(fig, ax)``, creating it on first use.
+
+    The figure is reused for every sheet the process renders; callers reset
+    it with ``ax.cla()``.
+    """
+    global _sheet_figure
+    if _sheet_figure is None:
+        _sheet_figure = plt.subplots(figsize=(4, 8))
+    return _sheet_figure
+
+
+def draw_sheet(fig, ax, thickness, sheet_id, rects, ply_width, ply_height, color, waste_percent):
+    """Draw one packed sheet onto ``fig``/``ax``, replacing what was there.
+
+    ``rects`` holds ``(x, y, w, h, ow, oh)`` rows.
+    """
+    ax.cla()
+    ax.set_xlim(0, ply_width)
+    ax.set_ylim(0, ply_height)
+    ax.set_aspect('equal')
+    ax.invert_yaxis()
+    ax.set_facecolor("#f5f5f5")
+
+    patches = [Rectangle((x, y), w, h) for x, y, w, h, _, _ in rects]
+    ax.add_collection(PatchCollection(patches, edgecolor='black', facecolor=color, lw=1.2),
+                      autolim=False)
+
+    # Label only pieces big enough to hold one at figure resolution. The
+    # labels have no bbox, which would add a FancyBboxPatch per piece.
+    box = ax.get_position()
+    px_per_mm = fig.dpi * min(fig.get_figwidth() * box.width / ply_width,
+                              fig.get_figheight() * box.height / ply_height)
+    for x, y, w, h, ow, oh in rects:
+        if w * px_per_mm >= LABEL_MIN_PX[0] and h * px_per_mm >= LABEL_MIN_PX[1]:
+            ax.text(x + w/2, y + h/2, f"{int(ow)}×{int(oh)}",
+                    fontsize=8, ha='center', va='center')
+
+    fig.suptitle(f"{thickness}mm Sheet {sheet_id+1} | Waste: {waste_percent:.2f}%", fontsize=10)
+
+
+def render_sheets(thickness, sheets, ply_width, ply_height, color):
+    """Render ``(sheet_id, rects, waste_percent)`` sheets as one PDF.
+
+    Every page is drawn on this process's reused figure and saved through a
+    single PdfPages, so fonts and backend state are set up once per batch
+    rather than once per sheet.
+    """
+    fig, ax = get_sheet_figure()
+    pdf_buf = BytesIO()
+    with PdfPages(pdf_buf) as pdf:
+        for sheet_id, rects, waste_percent in sheets:
+            draw_sheet(fig, ax, thickness, sheet_id, rects, ply_width, ply_height, color,
+                       waste_percent)
+            pdf.savefig(fig, dpi=PDF_DPI)
+    return pdf_buf.getvalue()
+
+
+def render_svg(rects, ply_width, ply_height, color):
+    """Render one packed sheet as an inline SVG preview.
+
+    Uses the sheet's millimetre coordinates as the viewBox, so it scales to
+    whatever width the page gives it. A piece is labelled only when its
+    label fits inside it at the preview's font size, which is relative to
+    the sheet width, so the preview can label different pieces from the
+    PDF's ``LABEL_MIN_PX`` rule.
+    """
+    font_size = ply_width / 30
+    parts = [
+        f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 {ply_width} {ply_height}'"
+        f" font-family='sans-serif' font-size='{font_size:.0f}'>",
+        f"<rect width='{ply_width}' height='{ply_height}' fill='#f5f5f5'/>",
+    ]
+    for x, y, w, h, _, _ in rects:
+        parts.append(f"<rect x='{x}' y='{y}' width='{w}' height='{h}' fill='{color}'"
+                     f" stroke='black' stroke-width='1' vector-effect='non-scaling-stroke'/>")
+    for x, y, w, h, ow, oh in rects:
+        label = f"{int(ow)}×{int(oh)}"
+        if w >= 0.6 * font_size * len(label) and h >= 1.2 * font_size:
+            parts.append(f"<text x='{x + w/2:g}' y='{y + h/2:g}' text-anchor='middle'"
+                         f" dominant-baseline='central'>{label}</text>")
+    parts.append("</svg>")
+    return "".join(parts)